@@ -1,8 +1,7 @@
-import random
+from concurrent.futures import ThreadPoolExecutor
 import sys
-from typing import List, Optional, Union
+from typing import Optional, Union
 
-from einops import rearrange
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -12,7 +11,16 @@ from agent import Agent
 from dataset import EpisodesDataset
 from envs import SingleProcessEnv, MultiProcessEnv
 from episode import Episode
-from utils import EpisodeDirManager, RandomHeuristic
+from utils import EpisodeDirManager
+
+
+def _prep_obs(img_u8: torch.Tensor, tok_i64: torch.Tensor) -> dict:
+    """Fuse the per-step NHWC->NCHW permute, float cast and /255 into one pass over the uint8 bytes."""
+    return {'image': img_u8.permute(0, 3, 1, 2).contiguous().to(torch.float32).div_(255), 'token': tok_i64.unsqueeze(-1)}
+
+
+if hasattr(torch, 'compile'):
+    _prep_obs = torch.compile(_prep_obs, mode='reduce-overhead')
 
 
 class Collector:
@@ -22,9 +30,40 @@ class Collector:
         self.episode_dir_manager = episode_dir_manager
         self.obs = self.env.reset()
         self.episode_ids = [None] * self.env.num_envs
-        self.heuristic = RandomHeuristic(self.env.num_actions)
-
-    @torch.no_grad()
+        self._rng = np.random.default_rng()
+        self._hist_bins = np.arange(0, self.env.num_actions + 1) - 0.5
+        self._buffer_capacity = 0
+        self._allocate_buffers(1024)
+        # Pinned staging buffers so the per-step host->device copy is async and stays uint8/int64,
+        # the float cast and /255 then happen on the device.
+        n, h, w, c = self.obs['image'].shape
+        pin = torch.cuda.is_available()
+        self._img_staging = torch.empty((n, h, w, c), dtype=torch.uint8, pin_memory=pin)
+        self._tok_staging = torch.empty((n,), dtype=torch.int64, pin_memory=pin)
+        self._burnin_img_staging = None  # lazily allocated (N, burn_in, C, H, W) pinned buffer
+        # Single worker : EpisodeDirManager's eviction / best-episode logic relies on saves staying ordered.
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = []
+
+    def _allocate_buffers(self, capacity: int) -> None:
+        # Rollout buffers are (T, N, ...) and written in place step by step, so flushing an
+        # episode is a slice instead of an np.array(...) copy over a list of per-step arrays.
+        n, h, w, c = self.obs['image'].shape
+        self._obs_img_buffer = np.empty((capacity, n, h, w, c), dtype=np.uint8)
+        self._obs_tok_buffer = np.empty((capacity, n), dtype=np.int64)
+        self._act_buffer = np.empty((capacity, n), dtype=np.int64)
+        self._rew_buffer = np.empty((capacity, n), dtype=np.float32)
+        self._done_buffer = np.empty((capacity, n), dtype=np.int64)
+        self._buffer_capacity = capacity
+
+    def _grow_buffers(self) -> None:
+        old = (self._obs_img_buffer, self._obs_tok_buffer, self._act_buffer, self._rew_buffer, self._done_buffer)
+        self._allocate_buffers(2 * self._buffer_capacity)
+        new = (self._obs_img_buffer, self._obs_tok_buffer, self._act_buffer, self._rew_buffer, self._done_buffer)
+        for old_buffer, new_buffer in zip(old, new):
+            new_buffer[:old_buffer.shape[0]] = old_buffer
+
+    @torch.inference_mode()
     def collect(self, agent: Agent, epoch: int, epsilon: float, should_sample: bool, temperature: float, burn_in: int, *, num_steps: Optional[int] = None, num_episodes: Optional[int] = None, info_flag = False):
         assert self.env.num_actions == agent.world_model.act_vocab_size
         assert 0 <= epsilon <= 1
@@ -37,7 +76,7 @@ class Collector:
         to_log = []
         steps, episodes = 0, 0
         returns = []
-        observations, actions, rewards, dones = [], [], [], []
+        t = 0  # number of steps currently stored in the rollout buffers
 
         burnin_obs_rec, mask_padding = None, None
         # print("burnin", burn_in)
@@ -45,43 +84,48 @@ class Collector:
             current_episodes = [self.dataset.get_episode(episode_id) for episode_id in self.episode_ids]
             segmented_episodes = [episode.segment(start=len(episode) - burn_in, stop=len(episode), should_pad=True) for episode in current_episodes]
             mask_padding = torch.stack([episode.mask_padding for episode in segmented_episodes], dim=0).to(agent.device)
-            # burnin_obs = torch.stack([episode.observations['image'] for episode in segmented_episodes], dim=0).float().div(255).to(agent.device)
-            burnin_obs_image = torch.stack([episode.observations['image'] for episode in segmented_episodes],
-                                           dim=0).float().div(255).to(agent.device)
+            # Stays uint8 : segments are copied by index into a reused pinned staging buffer (no stack
+            # copy), uploaded async, and the float cast and /255 happen on device in the tokenizer.
+            img_shape = (len(segmented_episodes), *segmented_episodes[0].observations['image'].shape)
+            if self._burnin_img_staging is None or self._burnin_img_staging.shape != img_shape:
+                self._burnin_img_staging = torch.empty(img_shape, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+            for i, episode in enumerate(segmented_episodes):
+                self._burnin_img_staging[i].copy_(episode.observations['image'])
+            burnin_obs_image = self._burnin_img_staging.to(agent.device, non_blocking=True)
             burnin_obs_token = torch.stack([episode.observations['token'] for episode in segmented_episodes], dim=0).to(
                 agent.device)
             burnin_obs = {'image': burnin_obs_image, 'token': burnin_obs_token}
             # print("token shape is ", burnin_obs_token.shape)
             # print('token in collector is ', burnin_obs_token)
-            burnin_obs_rec = {'image':torch.clamp(agent.tokenizer.encode_decode(burnin_obs, should_preprocess=True, should_postprocess=True), 0, 1) , 'token':rearrange(burnin_obs_token.unsqueeze(1), 'a b c -> a c b')}
+            burnin_obs_rec = {'image':torch.clamp(agent.tokenizer.encode_decode(burnin_obs, should_preprocess=True, should_postprocess=True), 0, 1) , 'token':burnin_obs_token.unsqueeze(-1)}
 
         agent.actor_critic.reset(n=self.env.num_envs, burnin_observations=burnin_obs_rec, mask_padding=mask_padding)
         pbar = tqdm(total=num_steps if num_steps is not None else num_episodes, desc=f'Experience collection ({self.dataset.name})', file=sys.stdout)
         # print('total ', num_steps , num_episodes)
         while not should_stop(steps, episodes):
 
-            observations.append(self.obs)
-            # print('in collector self.obs', self.obs.shape)
-            # print('bug position :', self.obs)
-            # if info_flag :
-                 # print()
-            img = rearrange(torch.FloatTensor(self.obs['image']).div(255), 'n h w c -> n c h w').to(agent.device)
-            token = torch.LongTensor(self.obs['token']).unsqueeze(-1).to(agent.device)
-            obs = {'image':img, 'token':token}
+            if t == self._buffer_capacity:
+                self._grow_buffers()
+            self._img_staging.copy_(torch.from_numpy(self.obs['image']))
+            self._tok_staging.copy_(torch.from_numpy(np.asarray(self.obs['token'], dtype=np.int64)))
+            obs = _prep_obs(self._img_staging.to(agent.device, non_blocking=True), self._tok_staging.to(agent.device, non_blocking=True))
             act = agent.act(obs, should_sample=should_sample, temperature=temperature).cpu().numpy()
 
-            if random.random() < epsilon:
-                act = self.heuristic.act(obs).cpu().numpy()
-
-            self.obs, reward, done, _ = self.env.step(act)
-            # print('self.obs is ', self.obs)
-            # print(self.env.unwrapped_)
-            # print('token: ', self.env.env.unwrapped.original_token)
-            # print(dir(self.env.env.env.env.unwrapped))
-            actions.append(act)
-            rewards.append(reward)
-            dones.append(done)
-            # print(done)
+            if epsilon > 0:
+                # Per-env exploration mask : sampled on CPU, no GPU round-trip for random actions.
+                heuristic_mask = self._rng.random(self.env.num_envs) < epsilon
+                if heuristic_mask.any():
+                    act[heuristic_mask] = self._rng.integers(0, self.env.num_actions, heuristic_mask.sum(), dtype=np.int64)
+
+            self.env.send_step(act)
+            # Workers step the envs while the current transition is committed to the rollout buffers.
+            self._obs_img_buffer[t] = self.obs['image']
+            self._obs_tok_buffer[t] = self.obs['token']
+            self._act_buffer[t] = act
+            self.obs, reward, done, _ = self.env.receive_step()
+            self._rew_buffer[t] = reward
+            self._done_buffer[t] = done
+            t += 1
             new_steps = len(self.env.mask_new_dones)
             steps += new_steps
             # print(steps, new_steps)
@@ -92,7 +136,8 @@ class Collector:
             # Not a problem with a SingleProcessEnv.
             # print('self.env.should_reset', self.env.should_reset())
             if self.env.should_reset():
-                self.add_experience_to_dataset(observations, actions, rewards, dones)
+                self.add_experience_to_dataset(t)
+                t = 0
 
                 new_episodes = self.env.num_envs
                 episodes += new_episodes
@@ -100,24 +145,30 @@ class Collector:
 
                 for episode_id in self.episode_ids:
                     episode = self.dataset.get_episode(episode_id)
-                    self.episode_dir_manager.save(episode, episode_id, epoch)
+                    self._pending_saves.append(self._io_pool.submit(self.episode_dir_manager.save, episode, episode_id, epoch))
                     metrics_episode = {k: v for k, v in episode.compute_metrics().__dict__.items()}
                     metrics_episode['episode_num'] = episode_id
-                    metrics_episode['action_histogram'] = wandb.Histogram(np_histogram=np.histogram(episode.actions.numpy(), bins=np.arange(0, self.env.num_actions + 1) - 0.5, density=True))
+                    action_counts = np.bincount(episode.actions.numpy(), minlength=self.env.num_actions).astype(np.float64)
+                    action_counts /= action_counts.sum()
+                    metrics_episode['action_histogram'] = wandb.Histogram(np_histogram=(action_counts, self._hist_bins))
                     to_log.append({f'{self.dataset.name}/{k}': v for k, v in metrics_episode.items()})
                     returns.append(metrics_episode['episode_return'])
 
                 self.obs = self.env.reset()
                 self.episode_ids = [None] * self.env.num_envs
                 agent.actor_critic.reset(n=self.env.num_envs)
-                observations, actions, rewards, dones = [], [], [], []
 
         # Add incomplete episodes to dataset, and complete them later.
-        if len(observations) > 0:
-            self.add_experience_to_dataset(observations, actions, rewards, dones)
+        if t > 0:
+            self.add_experience_to_dataset(t)
 
         agent.actor_critic.clear()
 
+        # Episode files must be on disk before the epoch's checkpointing runs (also surfaces save errors).
+        for future in self._pending_saves:
+            future.result()
+        self._pending_saves.clear()
+
         metrics_collect = {
             '#episodes': len(self.dataset),
             '#steps': sum(map(len, self.dataset.episodes)),
@@ -129,35 +180,22 @@ class Collector:
 
         return to_log
 
-    def add_experience_to_dataset(self, observations: List[dict], actions: List[np.ndarray], rewards: List[np.ndarray], dones: List[np.ndarray]) -> None:
-        # print('---------------', len(observations), len(actions) , len(rewards), len(dones))
-        assert len(observations) == len(actions) == len(rewards) == len(dones)
-        # print('len observations', len(observations))
-        # for i, (o, a, r, d) in enumerate(zip(*map(lambda arr: np.swapaxes(arr, 0, 1), [observations, actions, rewards, dones]))):  # Make everything (N, T, ...) instead of (T, N, ...)
-        # for i, (o, a, r, d) in enumerate(zip(*map(lambda arr: np.swapaxes(arr, 0, 1), [observations, actions, rewards, dones]))):  # Make everything (N, T, ...) instead of (T, N, ...)
-        # tt = []
-        # for i in observations:
-        #     obs.append({'image': np.swapaxes(i['image'], 0, 1), 'token': i['token']})
-        obs_img = [i['image'] for i in observations]
-        obs_token = [i['token'] for i in observations]  # todo this might be wrong
-        # print('obs_token is ', obs_token)
-        # obs_img = np.swapaxes(obs_img, 0, 1)
-        # obs_token = np.swapaxes(obs_token, 0, 1)
-        obs_img = np.array(obs_img)
-        obs_token = np.array(obs_token)
-        tt = [*map(lambda arr: np.swapaxes(arr, 0, 1), [obs_img, obs_token, actions, rewards, dones])]
-        # print('tt', tt )
+    def add_experience_to_dataset(self, num_steps: int) -> None:
+        assert 0 < num_steps <= self._buffer_capacity
+        # Make everything (N, T, ...) instead of (T, N, ...) : swapaxes on a slice is a view, not a copy.
+        tt = [*map(lambda arr: np.swapaxes(arr[:num_steps], 0, 1), [self._obs_img_buffer, self._obs_tok_buffer, self._act_buffer, self._rew_buffer, self._done_buffer])]
         for i, (img ,tok, a, r, d) in enumerate(zip(*tt)):
-            # print('iter', i)
-            img = torch.ByteTensor(img).permute(0, 3, 1, 2).contiguous()
-            tok = torch.LongTensor(tok)
-
+            # Buffers are reused across flushes, so every field must own its memory. The copies are
+            # unconditional : np.ascontiguousarray would hand back the live buffer view whenever the
+            # row happens to be contiguous already (num_envs == 1, or a one-step flush). The image
+            # copy doubles as the channel-first layout change; torch.from_numpy wraps without another.
+            img = torch.from_numpy(np.ascontiguousarray(img.transpose(0, 3, 1, 2)))
 
             episode = Episode(
-                observations={'image':img, 'token':tok},  # channel-first
-                actions=torch.LongTensor(a),
-                rewards=torch.FloatTensor(r),
-                ends=torch.LongTensor(d),
+                observations={'image':img, 'token':torch.from_numpy(tok.copy())},  # channel-first
+                actions=torch.from_numpy(a.copy()),
+                rewards=torch.from_numpy(r.copy()),
+                ends=torch.from_numpy(d.copy()),
                 mask_padding=torch.ones(d.shape[0], dtype=torch.bool),
             )
             # print(self.episode_ids)
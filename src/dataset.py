@@ -85,27 +85,19 @@ class EpisodesDataset:
         return sampled_episodes_segments
 
     def _collate_episodes_segments(self, episodes_segments: List[Episode]) -> Batch:
-        episodes_segments = [e_s.__dict__ for e_s in episodes_segments]
-        batch = {}
-        shape = episodes_segments[0]['actions'].shape
-        for k in episodes_segments[0]:
-            if k == "observations":
-                bat_img = torch.stack([e_s[k]['image'].float()/255.0 for e_s in episodes_segments])
-                # print()
-
-                # bat_tok = torch.stack([torch.tensor(e_s[k]['token']) if len(e_s[k]['token']) == shape else torch.zeros(shape) for e_s in episodes_segments])
-                try:
-                    bat_tok = torch.stack([torch.tensor(e_s[k]['token']) for e_s in episodes_segments])
-                except Exception as e:
-                    print('?')
-                # print('bat_tok in dataset is ', bat_tok)
-                # todo the tok sometimes become Tensor(0,)
-                #     bat_tok = torch.stack([e_s[k]['token'] for e_s in episodes_segments])
-                # RuntimeError: stack expects each tensor to be equal size, but got [1] at entry 0 and [0] at entry 1
-                batch[k] = {'image': bat_img, 'token': bat_tok}
-                continue
-            batch[k] = torch.stack([e_s[k] for e_s in episodes_segments])
-        # batch['observations'] = batch['observations'].float() / 255.0  # int8 to float and scale
+        # SoA-style collate : one contiguous buffer per field. Images are gathered as uint8 and cast
+        # to float in a single pass at the end, instead of one float()/255 copy per segment.
+        b = len(episodes_segments)
+        img_shape = episodes_segments[0].observations['image'].shape
+        tok_shape = episodes_segments[0].observations['token'].shape
+        bat_img = torch.empty((b, *img_shape), dtype=torch.uint8)
+        bat_tok = torch.empty((b, *tok_shape), dtype=torch.long)
+        for i, e_s in enumerate(episodes_segments):
+            bat_img[i].copy_(e_s.observations['image'])
+            bat_tok[i].copy_(e_s.observations['token'])
+        batch = {'observations': {'image': bat_img.float().div_(255), 'token': bat_tok}}
+        for k in ('actions', 'rewards', 'ends', 'mask_padding'):
+            batch[k] = torch.stack([getattr(e_s, k) for e_s in episodes_segments])
         return batch
 
     def traverse(self, batch_num_samples: int, chunk_size: int):
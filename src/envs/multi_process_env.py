@@ -89,9 +89,12 @@ class MultiProcessEnv(DoneTrackerEnv):
         # print('content in  multi ', content)
         return content
 
-    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Any]:
+    def send_step(self, actions: np.ndarray) -> None:
+        """Post actions to the workers and return immediately, so the caller can overlap work with env stepping."""
         for parent_conn, action in zip(self.parent_conns, actions):
             parent_conn.send(Message(MessageType.STEP, action))
+
+    def receive_step(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Any]:
         content = self._receive(check_type=MessageType.STEP_RETURN)
         # print('content in multi', content)
         obs, rew, done, _ = zip(*content)
@@ -105,6 +108,10 @@ class MultiProcessEnv(DoneTrackerEnv):
         self.update_done_tracker(done)
         return obs, np.stack(rew), done, None
 
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Any]:
+        self.send_step(actions)
+        return self.receive_step()
+
     def close(self) -> None:
         for parent_conn in self.parent_conns:
             parent_conn.send(Message(MessageType.CLOSE))
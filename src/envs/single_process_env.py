@@ -37,6 +37,14 @@ class SingleProcessEnv(DoneTrackerEnv):
         # print('token in single_process_env', tok)
         return {'image':img, 'token':tok}, np.array([reward]), done, None
 
+    def send_step(self, action) -> None:
+        # No worker to overlap with : step synchronously and hand the result back in receive_step.
+        self._step_result = self.step(action)
+
+    def receive_step(self) -> Tuple[dict, np.ndarray, np.ndarray, Any]:
+        result, self._step_result = self._step_result, None
+        return result
+
     def render(self) -> None:
         self.env.render()
 
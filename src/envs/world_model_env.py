@@ -2,14 +2,17 @@ import random
 from typing import List, Optional, Union
 
 import gym
-from einops import rearrange
 import numpy as np
 from PIL import Image
 import torch
-from torch.distributions.categorical import Categorical
 import torchvision
 
 
+def _sample_categorical(logits: torch.Tensor) -> torch.Tensor:
+    """Gumbel-max sampling, same distribution as Categorical(logits=logits).sample() without building a Distribution object per call."""
+    return (logits - torch.empty_like(logits).exponential_().log_()).argmax(dim=-1)
+
+
 class WorldModelEnv:
 
     def __init__(self, tokenizer: torch.nn.Module, world_model: torch.nn.Module, device: Union[str, torch.device], env: Optional[gym.Env] = None) -> None:
@@ -19,6 +22,7 @@ class WorldModelEnv:
         self.tokenizer = tokenizer.to(self.device).eval()
 
         self.keys_values_wm, self.obs_tokens, self._num_observations_tokens = None, None, None
+        self._obs_h = None  # side of the square obs token grid (excludes the trailing task token)
 
         self.env = env
 
@@ -52,6 +56,7 @@ class WorldModelEnv:
         _, num_observations_tokens = obs_tokens.shape
         if self.num_observations_tokens is None:
             self._num_observations_tokens = num_observations_tokens # 17
+            self._obs_h = int((num_observations_tokens - 1) ** 0.5)
 
         _ = self.refresh_keys_values_with_initial_obs_tokens(obs_tokens)
         self.obs_tokens = obs_tokens
@@ -73,35 +78,41 @@ class WorldModelEnv:
         # todo 写一下embedder怎么处理
         num_passes = 1 + self.num_observations_tokens if should_predict_next_obs else 1
 
-        output_sequence, obs_tokens = [], []
-        # self.obs_tokens = torch.cat((self.obs_tokens, torch.zeros((self.obs_tokens.shape[0] , 1)).to(self.device)),dim=1)
         if self.keys_values_wm.size + num_passes > self.world_model.config.max_tokens:
-            _ = self.refresh_keys_values_with_initial_obs_tokens(self.obs_tokens)
+            # Slide the cache window by one block instead of re-running the transformer over self.obs_tokens.
+            # num_passes is a whole block, so the obs/task/act token structure stays aligned, and prev_steps
+            # (derived from the cache size) shrinks accordingly for the positional embeddings.
+            self.keys_values_wm.shift_left(num_passes)
 
         token = action.clone().detach() if isinstance(action, torch.Tensor) else torch.tensor(action, dtype=torch.long)
         token = token.reshape(-1, 1).to(self.device)  # (B, 1)
 
+        # Preallocated outputs, written by index instead of a list + torch.cat at the end.
+        b = token.shape[0]
+        output_sequence = torch.empty(b, num_passes, self.world_model.config.embed_dim, device=self.device)  # (B, 1 + K, E)
+        obs_tokens = torch.empty(b, min(num_passes, self.num_observations_tokens), dtype=torch.long, device=self.device)  # (B, K)
+
         for k in range(num_passes):  # assumption that there is only one action token.
             # todo 忽略了最后一个task token 然后把任务里的最后一个token取出来给进去
 
             outputs_wm = self.world_model(token, past_keys_values=self.keys_values_wm) # 64 1
-            output_sequence.append(outputs_wm.output_sequence)
+            output_sequence[:, k] = outputs_wm.output_sequence[:, 0]
 
             if k == 0:
-                reward = Categorical(logits=outputs_wm.logits_rewards).sample().float().cpu().numpy().reshape(-1) / 2   # (B,)
-                # print('world model env reward', reward)
-                done = Categorical(logits=outputs_wm.logits_ends).sample().cpu().numpy().astype(bool).reshape(-1)       # (B,)
+                # Single device-to-host sync for reward and done instead of one per field.
+                reward_done = torch.stack((_sample_categorical(outputs_wm.logits_rewards).reshape(-1), _sample_categorical(outputs_wm.logits_ends).reshape(-1)), dim=1).cpu().numpy()
+                reward = reward_done[:, 0].astype(np.float32) / 2   # (B,)
+                done = reward_done[:, 1].astype(bool)               # (B,)
 
             if k < self.num_observations_tokens :
                 if k == self.num_observations_tokens - 1:
                     token = torch.zeros_like(token)
-                    obs_tokens.append(token)
+                    obs_tokens[:, k] = token[:, 0]
                     continue
-                token = Categorical(logits=outputs_wm.logits_observations).sample()
-                obs_tokens.append(token)
+                token = _sample_categorical(outputs_wm.logits_observations)
+                obs_tokens[:, k] = token[:, 0]
 
-        output_sequence = torch.cat(output_sequence, dim=1)   # (B, 1 + K, E)
-        self.obs_tokens = torch.cat(obs_tokens, dim=1)        # (B, K)
+        self.obs_tokens = obs_tokens
 
         obs = self.decode_obs_tokens() if should_predict_next_obs else None
         # print('obs shape is ', obs.shape)
@@ -110,7 +121,7 @@ class WorldModelEnv:
     @torch.no_grad()
     def render_batch(self) -> List[Image.Image]:
         frames = self.decode_obs_tokens().detach().cpu()
-        frames = rearrange(frames, 'b c h w -> b h w c').mul(255).numpy().astype(np.uint8)
+        frames = frames.permute(0, 2, 3, 1).mul(255).numpy().astype(np.uint8)
         return [Image.fromarray(frame) for frame in frames]
 
     @torch.no_grad()
@@ -120,7 +131,8 @@ class WorldModelEnv:
         # print('the word token is ', self.obs_tokens[:, -1])
         embedded_tokens = self.tokenizer.embedding(q)     # (B, K, E)
         # embedded_tokens = self.tokenizer.embedding(self.obs_tokens)
-        z = rearrange(embedded_tokens, 'b (h w) e -> b e h w', h=int(np.sqrt(self.num_observations_tokens)))
+        b, _, e = embedded_tokens.shape
+        z = embedded_tokens.transpose(1, 2).reshape(b, e, self._obs_h, self._obs_h)
         rec = self.tokenizer.decode(z, should_postprocess=True)         # (B, C, H, W)
         return {'image':torch.clamp(rec, 0, 1),'token':self.obs_tokens[:,-1].unsqueeze(-1)}
 
@@ -4,6 +4,23 @@ from pathlib import Path
 
 import torch
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, metrics fall back to NumPy
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _episode_return(rewards):
+        total = 0.0
+        for r in rewards:
+            total += r
+        return total
+else:
+    def _episode_return(rewards):
+        return float(rewards.sum())
+
 
 @dataclass
 class EpisodeMetrics:
@@ -86,7 +103,7 @@ class Episode:
         return segment
 
     def compute_metrics(self) -> EpisodeMetrics:
-        return EpisodeMetrics(len(self), self.rewards.sum())
+        return EpisodeMetrics(len(self), _episode_return(self.rewards.numpy()))
 
     def save(self, path: Path) -> None:
         torch.save(self.__dict__, path)
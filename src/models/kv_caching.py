@@ -28,6 +28,11 @@ class Cache:
     def get(self) -> torch.Tensor:
         return self._cache[:, :, :self._size, :]
 
+    def shift_left(self, n: int) -> None:
+        assert 0 < n <= self._size
+        self._cache[:, :, :self._size - n] = self._cache[:, :, n:self._size].clone()
+        self._size -= n
+
     def update(self, x: torch.Tensor) -> None:
         assert (x.ndim == self._cache.ndim) and all([x.size(i) == self._cache.size(i) for i in (0, 1, 3)])
         assert self._size + x.size(2) <= self._cache.shape[2]
@@ -52,6 +57,10 @@ class KVCache:
         self._k_cache.prune(mask)
         self._v_cache.prune(mask)
 
+    def shift_left(self, n: int) -> None:
+        self._k_cache.shift_left(n)
+        self._v_cache.shift_left(n)
+
     def get(self) -> Tuple[torch.Tensor, torch.Tensor]:
         return self._k_cache.get(), self._v_cache.get()
 
@@ -82,6 +91,11 @@ class KeysValues:
         for kv_cache in self._keys_values:
             kv_cache.prune(mask)
 
+    def shift_left(self, n: int) -> None:
+        """Evict the n oldest tokens so that only the new tokens pay an attention cost (no full recompute)."""
+        for kv_cache in self._keys_values:
+            kv_cache.shift_left(n)
+
 
 class AssignWithoutInplaceCheck(torch.autograd.Function):
     """
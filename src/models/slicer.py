@@ -15,12 +15,18 @@ class Slicer(nn.Module):
         kept_indices = torch.where(block_mask)[0].repeat(max_blocks)
         offsets = torch.arange(max_blocks).repeat_interleave(self.num_kept_tokens)
         self.register_buffer('indices', kept_indices + block_mask.size(0) * offsets)
+        self._slice_cache = {}
 
     def compute_slice(self, num_steps: int, prev_steps: int = 0) -> torch.Tensor:
-        total_steps = num_steps + prev_steps
-        num_blocks = math.ceil(total_steps / self.block_size)
-        indices = self.indices[:num_blocks * self.num_kept_tokens]
-        return indices[torch.logical_and(prev_steps <= indices, indices < total_steps)] - prev_steps
+        # The kept-token pattern repeats every block, so the slice only depends on
+        # (num_steps, prev_steps mod block_size) : compute it once per key and cache the tensor.
+        key = (num_steps, prev_steps % self.block_size)
+        if key not in self._slice_cache:
+            total_steps = key[0] + key[1]
+            num_blocks = math.ceil(total_steps / self.block_size)
+            indices = self.indices[:num_blocks * self.num_kept_tokens]
+            self._slice_cache[key] = indices[torch.logical_and(key[1] <= indices, indices < total_steps)] - key[1]
+        return self._slice_cache[key]
 
     def forward(self, *args, **kwargs):
         raise NotImplementedError
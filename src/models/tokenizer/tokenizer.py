@@ -108,7 +108,9 @@ class Tokenizer(nn.Module):
         return self.decode(z_q, should_postprocess)
 
     def preprocess_input(self, x: torch.Tensor) -> torch.Tensor:
-        """x is supposed to be channels first and in [0, 1]"""
+        """x is supposed to be channels first, uint8 in [0, 255] or float in [0, 1]"""
+        if x.dtype == torch.uint8:
+            x = x.to(torch.float32).div_(255)
         return x.mul(2).sub(1)
 
     def postprocess_output(self, y: torch.Tensor) -> torch.Tensor:
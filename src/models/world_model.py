@@ -1,7 +1,6 @@
 from dataclasses import dataclass
 from typing import Any, Optional, Tuple
 
-from einops import rearrange
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,6 +13,17 @@ from .transformer import Transformer, TransformerConfig
 from utils import init_weights, LossWithIntermediateLosses
 
 
+def _compute_labels(obs_tokens: torch.Tensor, rewards: torch.Tensor, ends: torch.Tensor, mask_fill: torch.BoolTensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    labels_observations = obs_tokens.masked_fill(mask_fill.unsqueeze(-1).expand_as(obs_tokens), -100).flatten(1)[:, 1:]
+    labels_rewards = (rewards * 2).masked_fill(mask_fill, -100).long()  # Rewards clipped to {-1, 0, 1}
+    labels_ends = ends.masked_fill(mask_fill, -100)
+    return labels_observations.reshape(-1), labels_rewards.reshape(-1), labels_ends.reshape(-1)
+
+
+if hasattr(torch, 'compile'):
+    _compute_labels = torch.compile(_compute_labels)
+
+
 @dataclass
 class WorldModelOutput:
     output_sequence: torch.FloatTensor
@@ -86,6 +96,8 @@ class WorldModel(nn.Module):
 
         self.apply(init_weights)
 
+        self._tokens_buffer = None  # lazily allocated (B, L, K+2) staging buffer for compute_loss
+
     def __repr__(self) -> str:
         return "world_model"
 
@@ -96,7 +108,8 @@ class WorldModel(nn.Module):
         prev_steps = 0 if past_keys_values is None else past_keys_values.size
 
         sequences = self.embedder(tokens, num_steps, prev_steps)
-        sequences += self.pos_emb(prev_steps + torch.arange(num_steps, device=tokens.device))
+        # Positions are consecutive, so slicing the embedding matrix replaces the arange + lookup.
+        sequences += self.pos_emb.weight[prev_steps:prev_steps + num_steps]
         # print('sequence shape', sequences.shape)
         x = self.transformer(sequences, past_keys_values)
 
@@ -111,29 +124,27 @@ class WorldModel(nn.Module):
         with torch.no_grad():
             obs_tokens = tokenizer.encode(batch['observations']['image'], should_preprocess=True).tokens  # (BL, K)
         # print('obs_tokens : ', obs_tokens.shape)
-        act_tokens = rearrange(batch['actions'], 'b l -> b l 1')
-        task_tokens = rearrange(batch['observations']['token'], 'b l -> b l 1')
-        # tokens = rearrange(torch.cat((obs_tokens,  act_tokens), dim=2), 'b l k1 -> b (l k1)')  # (B, L(K+1))
-        tokens = rearrange(torch.cat((obs_tokens, task_tokens, act_tokens), dim=2), 'b l k1 -> b (l k1)')  # (B, L(K+1))
+        # Slice-copy into a reused staging buffer instead of torch.cat allocating (B, L, K+2) every step.
+        # Safe to reuse across steps : the embedder's advanced indexing copies the slices it embeds,
+        # so autograd never holds a reference to the buffer itself.
+        b, l, k = obs_tokens.shape
+        if self._tokens_buffer is None or self._tokens_buffer.shape != (b, l, k + 2) or self._tokens_buffer.device != obs_tokens.device:
+            self._tokens_buffer = torch.empty(b, l, k + 2, dtype=torch.long, device=obs_tokens.device)
+        self._tokens_buffer[:, :, :k].copy_(obs_tokens)
+        self._tokens_buffer[:, :, k] = batch['observations']['token']
+        self._tokens_buffer[:, :, k + 1] = batch['actions']
+        tokens = self._tokens_buffer.flatten(1)  # (B, L(K+2))
         outputs = self(tokens)
-        # labels_observations, labels_rewards, labels_ends = self.compute_labels_world_model(torch.cat((obs_tokens, task_tokens), dim=2), batch['rewards'], batch['ends'], batch['mask_padding'])
         labels_observations, labels_rewards, labels_ends = self.compute_labels_world_model(obs_tokens, batch['rewards'], batch['ends'], batch['mask_padding'])
 
-        logits_observations = rearrange(outputs.logits_observations[:, :-1], 'b t o -> (b t) o')
+        logits_observations = outputs.logits_observations[:, :-1].flatten(0, 1)  # (BT, O)
 
-        # print('output shape ', log/its_observations.shape)
         loss_obs = F.cross_entropy(logits_observations, labels_observations)
-        loss_rewards = F.cross_entropy(rearrange(outputs.logits_rewards, 'b t e -> (b t) e'), labels_rewards)
-        loss_ends = F.cross_entropy(rearrange(outputs.logits_ends, 'b t e -> (b t) e'), labels_ends)
+        loss_rewards = F.cross_entropy(outputs.logits_rewards.flatten(0, 1), labels_rewards)
+        loss_ends = F.cross_entropy(outputs.logits_ends.flatten(0, 1), labels_ends)
 
         return LossWithIntermediateLosses(loss_obs=loss_obs, loss_rewards=loss_rewards, loss_ends=loss_ends)
 
-    def compute_labels_world_model(self, obs_tokens: torch.Tensor, rewards: torch.Tensor, ends: torch.Tensor, mask_padding: torch.BoolTensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    def compute_labels_world_model(self, obs_tokens: torch.Tensor, rewards: torch.Tensor, ends: torch.Tensor, mask_padding: torch.BoolTensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         assert torch.all(ends.sum(dim=1) <= 1)  # at most 1 done
-        mask_fill = torch.logical_not(mask_padding)
-        labels_observations = rearrange(obs_tokens.masked_fill(mask_fill.unsqueeze(-1).expand_as(obs_tokens), -100), 'b t k -> b (t k)')[:, 1:]
-        labels_rewards = (rewards * 2 ).masked_fill(mask_fill, -100).long()  # Rewards clipped to {-1, 0, 1}
-        labels_ends = ends.masked_fill(mask_fill, -100)
-        # print("real rewards", rewards)
-        # print('labels rewars', labels_rewards)
-        return labels_observations.reshape(-1), labels_rewards.reshape(-1), labels_ends.reshape(-1)
+        return _compute_labels(obs_tokens, rewards, ends, torch.logical_not(mask_padding))